@@ -1,9 +1,10 @@
 import os
-import json
-import requests
+import orjson
+import asyncio
+import aiohttp
+import contextlib
 import re
-import sys
-import time
+from aiolimiter import AsyncLimiter
 
 # --- 1. Load Configuration ---
 def load_config():
@@ -12,29 +13,41 @@ def load_config():
     if not os.path.exists(config_path):
         print(f"CRITICAL ERROR: config.json not found at: {config_path}")
         return None
-    with open(config_path, 'r') as f:
-        return json.load(f)
+    with open(config_path, 'rb') as f:
+        return orjson.loads(f.read())
 
 # --- 2. Helper: Read Text Files (Prompts/Examples) ---
+_file_cache = {}  # full path -> (mtime_ns, content)
+
 def read_file_content(filepath):
-    """Reads a text file relative to the script directory."""
+    """Reads a text file relative to the script directory.
+
+    Contents are cached and only re-read when the file's mtime changes.
+    """
     if not filepath: return ""
     
     base_dir = os.path.dirname(os.path.abspath(__file__))
     full_path = os.path.join(base_dir, filepath)
     
     try:
+        mtime = os.stat(full_path).st_mtime_ns
+        cached = _file_cache.get(full_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
         with open(full_path, 'r', encoding='utf-8') as f:
-            return f.read().strip()
+            content = f.read().strip()
     except FileNotFoundError:
         print(f"   [WARNING] File not found: {filepath}")
         return ""
 
+    _file_cache[full_path] = (mtime, content)
+    return content
+
 # --- 3. Helper: Extract Text from JSON ---
 def extract_text_from_json(filepath):
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(filepath, 'rb') as f:
+            data = orjson.loads(f.read())
         
         text_segments = []
         
@@ -71,37 +84,58 @@ def extract_text_from_json(filepath):
         return []
 
 # --- 4. Helper: Clean AI Response ---
+_PREFIXES = [
+    r"Here is the.*?translation.*?:", r"Sure, here is.*?:", r"Translation:", 
+    r"Below is the translation.*?:", r"The translation is as follows.*?:",
+    r"Here is the Urdu translation.*?:", r"Here is the English translation.*?:"
+]
+_SUFFIXES = [r"Note:.*", r"Please let me know.*", r"I hope this helps.*"]
+
+# One compiled alternation per side, so each response is scanned once per side.
+# Prefixes may be indented or chained ("Translation: Here is the ...:"), so the
+# group repeats and swallows the whitespace in between. Unlike the old
+# one-pattern-at-a-time loop, chains are stripped in any order.
+_PREFIX_ALT = "(?:" + "|".join(_PREFIXES) + ")"
+_PREFIX_RE = re.compile(r"^[ \t]*(?:" + _PREFIX_ALT + r"\s*)*" + _PREFIX_ALT, re.IGNORECASE | re.MULTILINE)
+_SUFFIX_RE = re.compile(r"(?:" + "|".join(_SUFFIXES) + r")", re.IGNORECASE | re.MULTILINE)
+
+# Latin (incl. German umlauts) or Arabic-script letters
+_LETTER_RE = re.compile(r"[A-Za-z\u0600-\u06FF\u00C0-\u024F]")
+
+def _is_translatable(text):
+    """False for empty, whitespace-only or letterless segments (e.g. bare page numbers)."""
+    return bool(text) and len(text.strip()) >= 3 and bool(_LETTER_RE.search(text))
+
 def clean_response(text):
     if not text: return ""
-    prefixes = [
-        r"^Here is the.*?translation.*?:", r"^Sure, here is.*?:", r"^Translation:", 
-        r"^Below is the translation.*?:", r"^The translation is as follows.*?:",
-        r"^Here is the Urdu translation.*?:", r"^Here is the English translation.*?:"
-    ]
-    suffixes = [r"Note:.*", r"Please let me know.*", r"I hope this helps.*"]
-
-    for p in prefixes:
-        text = re.sub(p, "", text, flags=re.IGNORECASE | re.MULTILINE).strip()
-    for s in suffixes:
-        text = re.sub(s, "", text, flags=re.IGNORECASE | re.MULTILINE).strip()
-    return text
+    text = _PREFIX_RE.sub("", text.strip()).strip()
+    return _SUFFIX_RE.sub("", text).strip()
 
 # --- 5. Core: Ollama API Call (Dynamic Prompts) ---
-def translate_segment(text, model_config, url):
-    model_name = model_config['base_model']
-    
-    # Load external files
+class TranslationError(Exception):
+    """Raised when a page could not be translated, e.g. because the LLM engine is down."""
+
+def build_prefix(model_config):
+    """Builds the constant part of the prompt, everything before the page text."""
     system_instruction = read_file_content(model_config.get('prompt_file'))
     examples = read_file_content(model_config.get('example_file'))
-    
-    # Construct the Final Prompt
+
     # Structure: [System Rules] -> [Examples] -> [Actual Task]
-    full_prompt = f"{system_instruction}\n\n"
+    prefix = f"{system_instruction}\n\n"
     
     if examples:
-        full_prompt += f"Here are examples of the required style:\n{examples}\n\n"
+        prefix += f"Here are examples of the required style:\n{examples}\n\n"
         
-    full_prompt += f"Source Text to Translate:\n{text}"
+    return prefix + "Source Text to Translate:\n"
+
+async def translate_segment_async(text, model_config, url, session, limiter, semaphore):
+    # Nothing to translate, don't spend a request on it
+    if not _is_translatable(text): return ""
+
+    model_name = model_config['base_model']
+    
+    # The prefix is identical for every page, which lets Ollama reuse its cached prefill
+    full_prompt = model_config['_prefix'] + text
 
     payload = {
         "model": model_name,
@@ -114,16 +148,26 @@ def translate_segment(text, model_config, url):
     }
     
     try:
-        response = requests.post(url, json=payload)
-        response.raise_for_status()
-        raw_text = response.json().get('response', '')
+        async with semaphore, limiter:
+            async with session.post(url, json=payload) as response:
+                response.raise_for_status()
+                raw_text = (await response.json()).get('response', '')
         return clean_response(raw_text)
     except Exception as e:
         print(f"\n[ERROR] API Error: {e}")
         return None
 
+# A page block as written to a .part file; a block cut off by a crash has no closing blank line
+_PART_PAGE_RE = re.compile(r"^--- Page (\d+) ---\n(.*?)\n\n(?=--- Page \d+ ---\n|\Z)", re.S | re.M)
+
+def read_part_file(part_path):
+    """Returns the pages a previous, interrupted run saved to a .part file, keyed by page index."""
+    if not os.path.exists(part_path): return {}
+    with open(part_path, encoding='utf-8') as f:
+        return {int(number) - 1: text for number, text in _PART_PAGE_RE.findall(f.read())}
+
 # --- 6. Main Execution Flow ---
-def main():
+async def main():
     config = load_config()
     if not config: return
 
@@ -131,6 +175,12 @@ def main():
     data_folder = os.path.join(base_dir, config['global_settings']['data_folder'])
     result_folder = os.path.join(base_dir, config['global_settings']['result_folder'])
     engine_url = config['llm_engine_url']
+    # Optional; a local Ollama server needs no rate limit
+    requests_per_minute = config['global_settings'].get('requests_per_minute')
+    # Ollama queues anything beyond OLLAMA_NUM_PARALLEL (4 by default), so
+    # more in-flight requests only wait on the server
+    max_concurrent_requests = config['global_settings'].get('max_concurrent_requests', 4)
+    max_concurrent_files = config['global_settings'].get('max_concurrent_files', 4)
     
     os.makedirs(data_folder, exist_ok=True)
     os.makedirs(result_folder, exist_ok=True)
@@ -152,44 +202,119 @@ def main():
     print(f"\nSelected: {selected_model_config['name']}")
     print(f"Loading Prompt from: {selected_model_config['prompt_file']}")
     print(f"Loading Examples from: {selected_model_config['example_file']}")
+    selected_model_config['_prefix'] = build_prefix(selected_model_config)
     
     # Find Files
     if not os.path.exists(data_folder): return
-    files = [f for f in os.listdir(data_folder) if f.endswith('.json')]
+    with os.scandir(data_folder) as it:
+        files = [e.name for e in it if e.is_file() and e.name.endswith('.json')]
     if not files: 
         print("No .json files found.")
         return
 
     print(f"Found {len(files)} files to process.")
 
-    for filename in files:
+    limiter = AsyncLimiter(requests_per_minute, 60) if requests_per_minute else contextlib.nullcontext()
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    # Ollama sends nothing until a request leaves its queue and the model
+    # finishes, which can take many minutes, so never time out a response;
+    # an engine that can't be reached still fails fast
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30)
+    # One pooled, keep-alive connector for the whole run
+    connector = aiohttp.TCPConnector(limit=32, limit_per_host=32)
+
+    async def process_one_file(filename, session):
         input_path = os.path.join(data_folder, filename)
         output_filename = filename.replace('.json', f"{selected_model_config['file_suffix']}.txt")
         output_path = os.path.join(result_folder, output_filename)
+        # Pages go to a .part file that only becomes the result once every page is done
+        part_path = output_path + ".part"
 
         if os.path.exists(output_path):
             print(f"[SKIP] {filename} already translated.")
-            continue
+            return
 
         print(f"Processing: {filename}...")
         segments = extract_text_from_json(input_path)
-        if not segments: continue
+        if not segments: return
 
-        with open(output_path, 'w', encoding='utf-8') as f: f.write("")
+        async def translate_page(i, segment):
+            return i, await translate_segment_async(segment, selected_model_config, engine_url, session, limiter, semaphore)
 
-        for i, segment in enumerate(segments):
-            print(f"   Translating Page {i+1}/{len(segments)}...", end="", flush=True)
-            translation = translate_segment(segment, selected_model_config, engine_url)
-            
+        def write_page(fp, i, translation):
+            print(f"   [{filename}] Page {i+1}/{len(segments)}...", end="", flush=True)
             if translation:
-                with open(output_path, 'a', encoding='utf-8') as f:
-                    f.write(f"--- Page {i+1} ---\n{translation}\n\n")
+                fp.write(f"--- Page {i+1} ---\n{translation}\n\n")
+                fp.flush()
                 print(" Saved.")
+            elif not _is_translatable(segments[i]):
+                print(" Skipped (no text).")
             else:
                 print(" Failed.")
-                if translation is None: sys.exit()
+
+        # Pick up the pages a failed run already translated
+        finished = {i: t for i, t in read_part_file(part_path).items() if i < len(segments)}
+        if finished:
+            print(f"   Resuming: {len(finished)} pages already translated.")
+
+        # Send the other pages at once and write them in page order as they finish
+        print(f"   Translating {len(segments) - len(finished)} pages...")
+        tasks = [asyncio.create_task(translate_page(i, s)) for i, s in enumerate(segments) if i not in finished]
+        next_page = 0
+        failed_page = None
+
+        with open(part_path, 'w', encoding='utf-8', buffering=1 << 16) as fp:
+            try:
+                while next_page in finished:
+                    write_page(fp, next_page, finished.pop(next_page))
+                    next_page += 1
+                for next_done in asyncio.as_completed(tasks):
+                    i, translation = await next_done
+                    if translation is None:
+                        failed_page = i
+                        break
+                    finished[i] = translation
+                    while next_page in finished:
+                        write_page(fp, next_page, finished.pop(next_page))
+                        next_page += 1
+            finally:
+                # Stop sending the remaining pages, but keep those already translated
+                for task in tasks:
+                    task.cancel()
+                for outcome in await asyncio.gather(*tasks, return_exceptions=True):
+                    if isinstance(outcome, tuple) and outcome[1] is not None and outcome[0] >= next_page:
+                        finished[outcome[0]] = outcome[1]
+                for i in sorted(finished):
+                    write_page(fp, i, finished[i])
+
+        if failed_page is not None:
+            raise TranslationError(
+                f"{filename}: page {failed_page+1} failed; translated pages kept in {part_path} for the next run"
+            )
+        os.replace(part_path, output_path)
+
+    # Files are independent, so several are translated at once. After an API
+    # error no new files are started; files already running finish or fail on their own.
+    file_semaphore = asyncio.Semaphore(max_concurrent_files)
+    errors = []
+
+    async def run(filename, session):
+        async with file_semaphore:
+            if errors: return
+            try:
+                await process_one_file(filename, session)
+            except TranslationError as e:
+                print(f"\n[ERROR] {e}")
+                errors.append(e)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        await asyncio.gather(*[run(filename, session) for filename in files])
+
+    if errors:
+        print("\nStopped after API errors; rerun to translate the remaining files.")
+        return
 
     print("\nAll jobs completed.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,104 @@
+import orjson
+import os
+
+# Pages sit three levels deep in a document
+_PAGE_INDENT = b"      "
+
+def checkpoint_path(output_path):
+    """Returns the JSON Lines checkpoint path that belongs to an output file."""
+    return output_path + ".jsonl"
+
+def source_fingerprint(path):
+    """Returns the size and modification time of a source file, to tell whether it was replaced."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def load_checkpoint(path, source=None):
+    """Reads the pages saved by previous runs.
+
+    Args:
+        path: Path to the JSON Lines checkpoint file
+        source: Optional fingerprint of the source file; a checkpoint that was
+            written for a different source is deleted instead of being read
+
+    Returns:
+        dict: Page dictionaries keyed by page number (empty if there is no checkpoint)
+    """
+    pages = {}
+    if not os.path.exists(path):
+        return pages
+
+    header = None
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                page = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # Partial line left behind by an interrupted write
+                continue
+            if "source" in page:
+                header = page["source"]
+                continue
+            pages[page["page_number"]] = page
+
+    if source is not None and header != source:
+        os.remove(path)
+        return {}
+    return pages
+
+def open_checkpoint(path, source=None):
+    """Opens a checkpoint file for appending, one page per line.
+
+    Args:
+        path: Path to the JSON Lines checkpoint file
+        source: Optional fingerprint of the source file, recorded at the top
+            of a new checkpoint
+
+    Returns:
+        file: Binary file object positioned at the end of the checkpoint
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fp = open(path, 'ab+')
+
+    # Start on a fresh line if the last write was cut off
+    end = fp.seek(0, os.SEEK_END)
+    if end > 0:
+        fp.seek(end - 1)
+        if fp.read(1) != b"\n":
+            fp.write(b"\n")
+    elif source is not None:
+        append_checkpoint(fp, {"source": source})
+    return fp
+
+def append_checkpoint(fp, page):
+    """Appends a single page to an open checkpoint file."""
+    fp.write(orjson.dumps(page, option=orjson.OPT_APPEND_NEWLINE))
+    fp.flush()
+
+def write_document_atomic(path, total_pages, pages):
+    """Writes a {"document": {"total_pages", "pages"}} JSON file without ever leaving a partial file.
+
+    The document is streamed: the header goes out first, then each page is
+    serialized and appended on its own, so only one page is held in
+    serialized form at a time. The output has the same indented layout as
+    dumping the whole document at once. It is written to a temporary file,
+    which replaces path once it is safely on disk.
+
+    Args:
+        path: Destination JSON file
+        total_pages: Page count stored in the document
+        pages: Iterable of page dictionaries, in output order
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b'{\n  "document": {\n    "total_pages": ' + orjson.dumps(total_pages) + b',\n    "pages": [')
+        first = True
+        for page in pages:
+            f.write(b"\n" if first else b",\n")
+            lines = orjson.dumps(page, option=orjson.OPT_INDENT_2).split(b"\n")
+            f.write(b"\n".join(_PAGE_INDENT + line for line in lines))
+            first = False
+        f.write(b"]\n  }\n}" if first else b"\n    ]\n  }\n}")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
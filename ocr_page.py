@@ -1,111 +1,199 @@
 import google.generativeai as genai
-from PIL import Image
-import time
-import re
-import threading
-import json
+from aiolimiter import AsyncLimiter
+from PIL import Image, ImageStat
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
 import os
+from checkpoint import append_checkpoint, checkpoint_path, load_checkpoint, open_checkpoint, source_fingerprint, write_document_atomic
+from rate_limit import parse_retry_delay
 
 # Rate limiter to avoid sending more than 12 requests per minute
-_request_lock = threading.Lock()
-_last_request_time = 0.0
-REQUEST_INTERVAL = 5.0  # seconds between requests
-
-def wait_for_rate_limit():
-    """Blocks until a new request is allowed under the REQUEST_INTERVAL policy."""
-    global _last_request_time
-    with _request_lock:
-        now = time.monotonic()
-        elapsed = now - _last_request_time
-        if elapsed < REQUEST_INTERVAL:
-            to_sleep = REQUEST_INTERVAL - elapsed
-            time.sleep(to_sleep)
-            now = time.monotonic()
-        _last_request_time = now
-
-def ocr_with_gemini(image):
+MAX_REQUESTS_PER_MINUTE = 11  # Gemini allows 12, keep one request of headroom
+LIMITER = AsyncLimiter(MAX_REQUESTS_PER_MINUTE, 60)
+
+# Cap on requests open at once, independent of the rate limit
+MAX_CONCURRENT_REQUESTS = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+HOST_SEM = None
+
+def _host_sem():
+    """Returns HOST_SEM, creating it on first use.
+
+    Before Python 3.10 a semaphore binds to the event loop that exists when
+    it is created, so it must not be created before asyncio.run() starts.
+    """
+    global HOST_SEM
+    if HOST_SEM is None:
+        HOST_SEM = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return HOST_SEM
+
+# Model and fixed prompt, shared by every request
+_MODEL = genai.GenerativeModel('gemini-flash-lite-latest')
+
+_HEAD = (
+    "You are an expert OCR tool. Analyze the provided image and express its content following these rules:",
+    "1. Read and understand all the text content on the page.",
+    "2. Rewrite the entire page's content as a single, flowing paragraph in German.",
+    "3. Make minimal adjustments to connect ideas smoothly while keeping the original meaning.",
+    "4. Maintain all technical information, facts, and key points accurately.",
+    "5. Exclude headers, footers, page numbers, and image captions.",
+    "6. Keep the technical terminology exactly as written.",
+    "7. Output only the final paragraph without any additional text or commentary.",
+    "8. Focus on creating a natural flow while preserving the original German content.",
+)
+
+# Page rendering runs in worker processes; rendered pages wait in a bounded queue
+RENDER_WORKERS = os.cpu_count() or 1
+OCR_CONCURRENCY = MAX_REQUESTS_PER_MINUTE  # pages being OCR'd at once
+
+# Rendering: 1.5x the PDF's 72 dpi, sent to Gemini as JPEG
+RENDER_ZOOM = 1.5
+JPEG_QUALITY = 85
+
+# Pages whose grayscale standard deviation is below this are treated as blank
+BLANK_PAGE_STDDEV = 5.0
+
+# PDFs processed at once; they share LIMITER, HOST_SEM and the render workers
+MAX_CONCURRENT_FILES = 4
+
+# Documents opened by the current render worker process, least recently used first
+_worker_docs = {}
+
+def _is_blank(image):
+    """True if the page image is (nearly) uniform, i.e. has no content to OCR."""
+    return ImageStat.Stat(image.convert("L")).stddev[0] < BLANK_PAGE_STDDEV
+
+def _render_page(pdf_path, page_index):
+    """Renders a single PDF page to JPEG bytes. Runs in a render worker process.
+
+    Args:
+        pdf_path: Path to the PDF file
+        page_index: Zero-based index of the page to render
+
+    Returns:
+        tuple: (page_number, JPEG bytes), with None instead of bytes for a blank page
+    """
+    import fitz  # PyMuPDF
+    doc = _worker_docs.pop(pdf_path, None)
+    if doc is None:
+        doc = fitz.open(pdf_path)
+        # Keep one document open per PDF in flight
+        if len(_worker_docs) >= MAX_CONCURRENT_FILES:
+            _worker_docs.pop(next(iter(_worker_docs))).close()
+    _worker_docs[pdf_path] = doc
+
+    page = doc.load_page(page_index)
+    pix = page.get_pixmap(matrix=fitz.Matrix(RENDER_ZOOM, RENDER_ZOOM), colorspace=fitz.csRGB)
+
+    # Check for blank pages here, while the raw pixels are at hand
+    image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    if _is_blank(image):
+        return page_index + 1, None
+    return page_index + 1, pix.tobytes("jpg", jpg_quality=JPEG_QUALITY)
+
+async def render_pages(pdf_path, page_indices, executor, queue):
+    """Renders pages in the executor and queues them as they finish.
+
+    At most RENDER_WORKERS pages are rendered at a time, and the bounded
+    queue stalls rendering while the OCR workers catch up.
+
+    Args:
+        pdf_path: Path to the PDF file
+        page_indices: Zero-based indices of the pages to render
+        executor: ProcessPoolExecutor running _render_page
+        queue: asyncio.Queue receiving (page_number, JPEG bytes or None) items
+    """
+    loop = asyncio.get_running_loop()
+    for start in range(0, len(page_indices), RENDER_WORKERS):
+        futures = [
+            loop.run_in_executor(executor, _render_page, pdf_path, page_index)
+            for page_index in page_indices[start:start + RENDER_WORKERS]
+        ]
+        for finished in asyncio.as_completed(futures):
+            await queue.put(await finished)
+
+async def ocr_with_gemini(image_data):
     """Performs OCR on a single image using Gemini, filtering for meaningful automotive-related sentences.
 
     Args:
-        image: A PIL Image object containing the scanned page
+        image_data: JPEG bytes of the scanned page, or None if the page is blank
 
     Returns:
-        str: Extracted text with one sentence per line, filtered for automotive content
+        str: Extracted text with one sentence per line, filtered for automotive
+        content, or None if every attempt failed
     """
-    model = genai.GenerativeModel('gemini-flash-lite-latest')
-
-    prompt = [
-        "You are an expert OCR tool. Analyze the provided image and express its content following these rules:",
-        "1. Read and understand all the text content on the page.",
-        "2. Rewrite the entire page's content as a single, flowing paragraph in German.",
-        "3. Make minimal adjustments to connect ideas smoothly while keeping the original meaning.",
-        "4. Maintain all technical information, facts, and key points accurately.",
-        "5. Exclude headers, footers, page numbers, and image captions.",
-        "6. Keep the technical terminology exactly as written.",
-        "7. Output only the final paragraph without any additional text or commentary.",
-        "8. Focus on creating a natural flow while preserving the original German content.",
-        image
-    ]
+    # Blank pages (flagged by the renderer) would only cost a request
+    if image_data is None:
+        return ""
+
+    prompt = list(_HEAD) + [{"mime_type": "image/jpeg", "data": image_data}]
 
     max_retries = 12
     base_backoff = 2.0
     for attempt in range(1, max_retries + 1):
         try:
-            wait_for_rate_limit()
-            response = model.generate_content(prompt)
+            async with _host_sem(), LIMITER:
+                # The Gemini SDK is synchronous, so run the call in a worker thread
+                response = await asyncio.to_thread(_MODEL.generate_content, prompt)
             return response.text
         except Exception as e:
             err_text = str(e)
             print(f"Attempt {attempt}/{max_retries} - OCR error: {err_text}")
 
-            # Try to parse a suggested retry delay from the message
-            sleep_seconds = None
-            m = re.search(r"Please retry in ([0-9]+(?:\.[0-9]+)?)s", err_text)
-            if m:
-                try:
-                    sleep_seconds = float(m.group(1)) + 1.0
-                except Exception:
-                    sleep_seconds = None
-            else:
-                m2 = re.search(r"retry_delay\W+seconds:\s*([0-9]+)", err_text)
-                if m2:
-                    try:
-                        sleep_seconds = float(m2.group(1)) + 1.0
-                    except Exception:
-                        sleep_seconds = None
+            # Prefer the retry delay suggested by the server
+            sleep_seconds = parse_retry_delay(err_text)
 
             if sleep_seconds is None:
                 # exponential backoff (cap at 60s)
                 sleep_seconds = min(60.0, base_backoff * (2 ** (attempt - 1)))
 
             print(f"Waiting {sleep_seconds:.1f}s before retrying OCR (attempt {attempt})")
-            time.sleep(sleep_seconds)
+            await asyncio.sleep(sleep_seconds)
 
     print(f"OCR failed after {max_retries} attempts.")
-    return ""
+    return None
+
+async def process_pdf_pages(pdf_path, total_pages, output_path, executor):
+    """Render and OCR the pages of a PDF and save the results to a JSON file.
 
-def process_pdf_pages(images, output_path):
-    """Process a list of page images and save the results to a JSON file.
+    Pages are rendered in worker processes and OCR'd concurrently as they
+    become available; LIMITER keeps the request rate in check. Each finished
+    page is appended to a JSON Lines checkpoint next to the output file, and
+    pages already in the checkpoint are skipped when the PDF is processed again.
+    The checkpoint records the PDF's size and modification time and is thrown
+    away if the PDF has been replaced since.
+    Pages whose OCR failed are saved empty but left out of the checkpoint, so
+    the next run retries them.
     
     Args:
-        images: List of PIL Image objects, one per page
+        pdf_path: Path to the PDF file
+        total_pages: Number of pages in the PDF
         output_path: Path where to save the JSON output file
+        executor: ProcessPoolExecutor used to render pages
     
     Returns:
         dict: Dictionary containing the processed results
     """
-    results = {
-        "document": {
-            "total_pages": len(images),
-            "pages": []
-        }
-    }
-    
-    for page_num, image in enumerate(images, 1):
-        print(f"Processing page {page_num}/{len(images)}...")
+    name = os.path.basename(pdf_path)
+
+    # Resume from the pages processed by previous runs
+    jsonl_path = checkpoint_path(output_path)
+    source = source_fingerprint(pdf_path)
+    saved = load_checkpoint(jsonl_path, source)
+    done = {number: page for number, page in saved.items() if 1 <= number <= total_pages}
+    page_indices = [i for i in range(total_pages) if i + 1 not in done]
+    if done:
+        print(f"[{name}] Resuming: {len(done)} pages already processed.")
+    failed = {}
+
+    async def process_page(page_num, image_data):
+        print(f"[{name}] Processing page {page_num}/{total_pages}...")
         
         # Extract text from the page
-        extracted_text = ocr_with_gemini(image)
+        extracted_text = await ocr_with_gemini(image_data)
+        if extracted_text is None:
+            # Keep the page out of the checkpoint so a rerun retries it
+            failed[page_num] = {"page_number": page_num, "content": ""}
+            return
         
         # Clean up the extracted text and ensure it's a single paragraph
         content = extracted_text.strip()
@@ -115,10 +203,54 @@ def process_pdf_pages(images, output_path):
             "page_number": page_num,
             "content": content
         }
-        results["document"]["pages"].append(page_data)
+        done[page_num] = page_data
         
         # Save intermediate results after each page
-        save_json_results(results, output_path)
+        append_checkpoint(fp, page_data)
+
+    queue = asyncio.Queue(maxsize=OCR_CONCURRENCY)
+
+    async def producer():
+        await render_pages(pdf_path, page_indices, executor, queue)
+        # One stop marker per OCR worker
+        for _ in range(OCR_CONCURRENCY):
+            await queue.put(None)
+
+    async def ocr_worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            page_num, image_data = item
+            await process_page(page_num, image_data)
+
+    with open_checkpoint(jsonl_path, source) as fp:
+        tasks = [asyncio.create_task(producer())]
+        tasks += [asyncio.create_task(ocr_worker()) for _ in range(OCR_CONCURRENCY)]
+        try:
+            # A failure anywhere stops the rest: dead workers would leave the
+            # producer blocked on the full queue, and a dead producer would
+            # leave the workers waiting for pages forever
+            done_tasks, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    for task in done_tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+    if failed:
+        print(f"[{name}] OCR failed for {len(failed)} pages; rerun to retry them.")
+    pages = {**done, **failed}
+    results = {
+        "document": {
+            "total_pages": total_pages,
+            "pages": [pages[number] for number in sorted(pages)]
+        }
+    }
+    save_json_results(results, output_path)
         
     return results
 
@@ -130,13 +262,38 @@ def save_json_results(results, output_path):
         output_path: Path where to save the JSON file
     """
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+    document = results["document"]
+    write_document_atomic(output_path, document["total_pages"], document["pages"])
 
-if __name__ == "__main__":
+async def process_one_pdf(pdf_path, output_dir, executor):
+    """OCR one PDF into {name}_ocr.json in the output directory, reporting errors.
+
+    Args:
+        pdf_path: Path to the PDF file
+        output_dir: Directory for the JSON output
+        executor: ProcessPoolExecutor used to render pages
+    """
     import fitz  # PyMuPDF
-    import io
+
+    filename = os.path.basename(pdf_path)
+    base_name = os.path.splitext(filename)[0]
+    json_output_path = os.path.join(output_dir, f"{base_name}_ocr.json")
+
+    print(f"\nProcessing PDF: {filename}")
+
+    try:
+        with fitz.open(pdf_path) as doc:
+            total_pages = len(doc)
+
+        # Render, OCR and save all pages
+        await process_pdf_pages(pdf_path, total_pages, json_output_path, executor)
+        print(f"Successfully processed {filename}. Output saved to {json_output_path}")
+
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
+
+async def main():
+    """OCR every PDF in the pdfs directory into the output directory."""
     import sys
     from dotenv import load_dotenv
 
@@ -159,44 +316,17 @@ if __name__ == "__main__":
 
     os.makedirs(output_dir, exist_ok=True)
 
-    # Process each PDF in the directory
-    for filename in os.listdir(pdf_dir):
-        if not filename.lower().endswith('.pdf'):
-            continue
-
-        pdf_path = os.path.join(pdf_dir, filename)
-        base_name = os.path.splitext(filename)[0]
-        json_output_path = os.path.join(output_dir, f"{base_name}_ocr.json")
-
-        print(f"\nProcessing PDF: {filename}")
+    # Process the PDFs in the directory, several at a time
+    with os.scandir(pdf_dir) as it:
+        files = [e.name for e in it if e.is_file() and e.name.lower().endswith('.pdf')]
+    file_sem = asyncio.Semaphore(MAX_CONCURRENT_FILES)
 
-        try:
-            # Open PDF and convert pages to images
-            doc = fitz.open(pdf_path)
-            images = []
-            for page_num in range(len(doc)):
-                page = doc.load_page(page_num)
-                pix = page.get_pixmap()
-                img_data = pix.tobytes("png")
-                image = Image.open(io.BytesIO(img_data))
-                images.append(image)
-            
-            # Process all pages and save results
-            results = process_pdf_pages(images, json_output_path)
-            print(f"Successfully processed {filename}. Output saved to {json_output_path}")
+    with ProcessPoolExecutor(max_workers=RENDER_WORKERS) as executor:
+        async def run(filename):
+            async with file_sem:
+                await process_one_pdf(os.path.join(pdf_dir, filename), output_dir, executor)
 
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
-            continue
+        await asyncio.gather(*[run(filename) for filename in files])
 
-        finally:
-            # Clean up
-            for img in images:
-                try:
-                    img.close()
-                except:
-                    pass
-            try:
-                doc.close()
-            except:
-                pass
+if __name__ == "__main__":
+    asyncio.run(main())
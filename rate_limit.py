@@ -0,0 +1,23 @@
+import re
+
+# Patterns Gemini uses to suggest a retry interval in 429 errors
+_RETRY_IN_RE = re.compile(r"Please retry in ([0-9]+(?:\.[0-9]+)?)s")
+_RETRY_DELAY_RE = re.compile(r"retry_delay\W+seconds:\s*([0-9]+)")
+
+def parse_retry_delay(err_text):
+    """Extracts the server-suggested retry delay from a Gemini error message.
+
+    Args:
+        err_text: String form of the exception raised by the SDK
+
+    Returns:
+        float: Seconds to wait (with one second of margin), or None if the
+            message does not suggest a delay
+    """
+    m = _RETRY_IN_RE.search(err_text) or _RETRY_DELAY_RE.search(err_text)
+    if not m:
+        return None
+    try:
+        return float(m.group(1)) + 1.0
+    except ValueError:
+        return None
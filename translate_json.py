@@ -1,26 +1,66 @@
 import os
-import json
-import time
-import threading
+import re
+import orjson
+import asyncio
 import google.generativeai as genai
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
+from checkpoint import append_checkpoint, checkpoint_path, load_checkpoint, open_checkpoint, write_document_atomic
+from rate_limit import parse_retry_delay
+
+try:
+    import simdjson  # pysimdjson, faster parsing of large OCR documents
+except ImportError:
+    simdjson = None
 
 # Rate limiter setup
-_request_lock = threading.Lock()
-_last_request_time = 0.0
-REQUEST_INTERVAL = 5.0  # seconds between requests
-
-def wait_for_rate_limit():
-    """Blocks until a new request is allowed under the REQUEST_INTERVAL policy."""
-    global _last_request_time
-    with _request_lock:
-        now = time.monotonic()
-        elapsed = now - _last_request_time
-        if elapsed < REQUEST_INTERVAL:
-            to_sleep = REQUEST_INTERVAL - elapsed
-            time.sleep(to_sleep)
-            now = time.monotonic()
-        _last_request_time = now
+MAX_REQUESTS_PER_MINUTE = 11  # Gemini allows 12, keep one request of headroom
+LIMITER = AsyncLimiter(MAX_REQUESTS_PER_MINUTE, 60)
+
+# Cap on requests open at once, independent of the rate limit
+MAX_CONCURRENT_REQUESTS = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+HOST_SEM = None
+
+def _host_sem():
+    """Returns HOST_SEM, creating it on first use.
+
+    Before Python 3.10 a semaphore binds to the event loop that exists when
+    it is created, so it must not be created before asyncio.run() starts.
+    """
+    global HOST_SEM
+    if HOST_SEM is None:
+        HOST_SEM = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return HOST_SEM
+
+# Files translated at once; they share LIMITER and HOST_SEM
+MAX_CONCURRENT_FILES = 4
+
+# Batching: several pages share one request
+BATCH_SIZE = 8
+MAX_BATCH_TOKENS = 6000  # the batched translation has to fit in one response
+_PAGE_RE = re.compile(r"<<<PAGE (\d+)>>>\s*(.*?)\s*<<<END \1>>>", re.DOTALL)
+
+# Model and fixed prompt parts, shared by every request
+_MODEL = genai.GenerativeModel('gemini-flash-lite-latest')
+
+_HEAD = (
+    "Translate the following German paragraph to English. Rules:",
+    "1. Maintain technical accuracy and terminology",
+    "2. Keep the same flowing, paragraph style",
+    "3. Preserve all technical information",
+    "4. Output only the English translation, no additional text",
+    "---",
+)
+_TAIL = ("---",)
+
+_BATCH_HEAD = (
+    "Translate each of the following German pages to English. Rules:",
+    "1. Maintain technical accuracy and terminology",
+    "2. Keep the same flowing, paragraph style",
+    "3. Preserve all technical information",
+    "4. Translate every page separately and keep its <<<PAGE i>>> and <<<END i>>> markers",
+    "5. Output only the marked English translations, no additional text",
+)
 
 def configure_api():
     """Loads the Gemini API key from .env file."""
@@ -30,38 +70,23 @@ def configure_api():
         raise ValueError("GEMINI_API_KEY not found. Please set it in the .env file.")
     genai.configure(api_key=api_key)
 
-def translate_paragraph(german_text):
-    """Translate a German paragraph to English using Gemini.
-    
+async def generate_translation(prompt):
+    """Send a translation prompt to Gemini, retrying on errors and empty output.
+
     Args:
-        german_text: A string containing German text
-    
+        prompt: List of prompt parts for generate_content
+
     Returns:
-        str: English translation of the text
+        str: Stripped response text, or None if every attempt failed
     """
-    if not german_text or not german_text.strip():
-        return ""
-
-    model = genai.GenerativeModel('gemini-flash-lite-latest')
-    
-    prompt = [
-        "Translate the following German paragraph to English. Rules:",
-        "1. Maintain technical accuracy and terminology",
-        "2. Keep the same flowing, paragraph style",
-        "3. Preserve all technical information",
-        "4. Output only the English translation, no additional text",
-        "---",
-        german_text,
-        "---"
-    ]
-    
     max_retries = 12
     base_backoff = 2.0
     
     for attempt in range(1, max_retries + 1):
         try:
-            wait_for_rate_limit()
-            response = model.generate_content(prompt)
+            async with _host_sem(), LIMITER:
+                # The Gemini SDK is synchronous, so run the call in a worker thread
+                response = await asyncio.to_thread(_MODEL.generate_content, prompt)
             translation = response.text.strip()
             if translation:
                 return translation
@@ -70,77 +95,221 @@ def translate_paragraph(german_text):
             
         except Exception as e:
             print(f"Attempt {attempt}/{max_retries} - Translation error: {e}")
-            sleep_seconds = min(60.0, base_backoff * (2 ** (attempt - 1)))
-            time.sleep(sleep_seconds)
+            # Prefer the retry delay suggested by the server
+            sleep_seconds = parse_retry_delay(str(e))
+            if sleep_seconds is None:
+                sleep_seconds = min(60.0, base_backoff * (2 ** (attempt - 1)))
+            await asyncio.sleep(sleep_seconds)
     
-    return "[Translation failed]"
+    return None
 
-def translate_json_file(input_path, output_path):
+async def translate_paragraph(german_text):
+    """Translate a German paragraph to English using Gemini.
+    
+    Args:
+        german_text: A string containing German text
+    
+    Returns:
+        str: English translation of the text, or None if the translation failed
+    """
+    if not german_text or not german_text.strip():
+        return ""
+
+    prompt = list(_HEAD) + [german_text] + list(_TAIL)
+    
+    return await generate_translation(prompt) or None
+
+def pack_pages(pages, batch_size=BATCH_SIZE):
+    """Group pages into batches of at most batch_size pages and MAX_BATCH_TOKENS tokens.
+
+    Tokens are estimated as len(text) // 4.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for page in pages:
+        page_tokens = len(page["content"]) // 4
+        if batch and (len(batch) == batch_size or batch_tokens + page_tokens > MAX_BATCH_TOKENS):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(page)
+        batch_tokens += page_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+async def translate_batch(pages):
+    """Translate several pages with a single Gemini request.
+
+    Each page is wrapped in <<<PAGE i>>> ... <<<END i>>> markers so the response
+    can be split back into pages. Pages missing from the response are
+    translated one by one instead; if the request itself fails, every page
+    is reported as failed.
+    
+    Args:
+        pages: List of page dicts with "page_number" and "content"
+    
+    Returns:
+        list: English translations (None where translation failed), in the
+        same order as pages
+    """
+    if len(pages) == 1:
+        return [await translate_paragraph(pages[0]["content"])]
+
+    prompt = list(_BATCH_HEAD)
+    for i, page in enumerate(pages, 1):
+        prompt.append(f"<<<PAGE {i}>>>\n{page['content']}\n<<<END {i}>>>")
+
+    response = await generate_translation(prompt)
+    if response is None:
+        # The retries are already used up; retrying page by page would only repeat them
+        return [None] * len(pages)
+    parsed = {int(i): text.strip() for i, text in _PAGE_RE.findall(response)}
+
+    translations = [parsed.get(i) or None for i in range(1, len(pages) + 1)]
+    missing = [i for i, translation in enumerate(translations) if translation is None]
+    for i in missing:
+        print(f"Batch response missing page {pages[i]['page_number']}, translating it separately...")
+    retried = await asyncio.gather(*[translate_paragraph(pages[i]["content"]) for i in missing])
+    for i, translation in zip(missing, retried):
+        translations[i] = translation
+    return translations
+
+async def batch_translate(pages, batch_size=BATCH_SIZE):
+    """Translate pages in batches, yielding results as each batch completes.
+    
+    Args:
+        pages: List of page dicts with "page_number" and "content"
+        batch_size: Maximum number of pages per request
+    
+    Yields:
+        tuple: (page, english_text) for every input page
+    """
+    # Empty pages need no request
+    non_empty = []
+    for page in pages:
+        if page["content"] and page["content"].strip():
+            non_empty.append(page)
+        else:
+            yield page, ""
+
+    batches = pack_pages(non_empty, batch_size)
+
+    async def run(batch):
+        return batch, await translate_batch(batch)
+
+    for finished in asyncio.as_completed([run(batch) for batch in batches]):
+        batch, english_texts = await finished
+        for page, english_text in zip(batch, english_texts):
+            yield page, english_text
+
+async def translate_json_file(input_path, output_path):
     """Translate content from input JSON file and save to output JSON file.
+
+    Pages are sent in batches, and batches are translated concurrently; the
+    LIMITER keeps the request rate in check. Each finished page is appended
+    to a JSON Lines checkpoint next to the output file, and pages already in
+    the checkpoint are skipped when the file is translated again, unless their
+    German text has changed since. Failed
+    pages are marked "[Translation failed]" in the output but left out of the
+    checkpoint, so the next run retries them.
     
     Args:
         input_path: Path to input JSON file with German text
         output_path: Path to save translated JSON file
     """
     print(f"\nReading: {input_path}")
+    name = os.path.basename(input_path)
     
-    # Read input JSON
-    with open(input_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    # Read input JSON (simdjson proxies are only valid while their parser is alive)
+    if simdjson is not None:
+        parser = simdjson.Parser()
+        data = parser.load(input_path)
+    else:
+        with open(input_path, 'rb') as f:
+            data = orjson.loads(f.read())
     
-    # Create output structure
-    translations = {
-        "document": {
-            "total_pages": data["document"]["total_pages"],
-            "pages": []
-        }
-    }
-    
-    # Process each page
+    # Resume from the pages translated by previous runs, as long as their
+    # German text still matches the input (a rerun of the OCR may have filled it in)
+    jsonl_path = checkpoint_path(output_path)
+    saved = load_checkpoint(jsonl_path)
+    done = {}
+    pending = []
     for page in data["document"]["pages"]:
-        print(f"Translating page {page['page_number']}...")
-        
-        # Translate the content
-        german_text = page["content"]
-        english_text = translate_paragraph(german_text)
-        
-        # Create the translated page entry
-        translated_page = {
-            "page_number": page["page_number"],
-            "german": german_text,
-            "english": english_text
-        }
-        
-        translations["document"]["pages"].append(translated_page)
-        
-        # Save progress after each page
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(translations, f, ensure_ascii=False, indent=2)
-        
-        print(f"Completed page {page['page_number']}")
+        number = page["page_number"]
+        if number in saved and saved[number]["german"] == page["content"]:
+            done[number] = saved[number]
+        else:
+            pending.append(page)
+    if done:
+        print(f"[{name}] Resuming: {len(done)} pages already translated.")
+    
+    print(f"[{name}] Translating {len(pending)} pages...")
+    failed = {}
+    with open_checkpoint(jsonl_path) as fp:
+        async for page, english_text in batch_translate(pending):
+            # Create the translated page entry
+            translated_page = {
+                "page_number": page["page_number"],
+                "german": page["content"],
+                "english": english_text
+            }
+            
+            if english_text is None:
+                # Keep the page out of the checkpoint so a rerun retries it
+                translated_page["english"] = "[Translation failed]"
+                failed[page["page_number"]] = translated_page
+                print(f"[{name}] Translation failed for page {page['page_number']}")
+                continue
+            
+            # Save progress after each page
+            append_checkpoint(fp, translated_page)
+            done[page["page_number"]] = translated_page
+            
+            print(f"[{name}] Completed page {page['page_number']}")
+    
+    if failed:
+        print(f"[{name}] {len(failed)} pages failed; rerun to retry them.")
+    
+    # Write the output document page by page
+    pages = {**done, **failed}
+    write_document_atomic(
+        output_path,
+        data["document"]["total_pages"],
+        (pages[number] for number in sorted(pages))
+    )
     
     print(f"\nTranslation completed. Saved to: {output_path}")
 
-def main():
+async def process_one_file(filename, output_dir):
+    """Translate one OCR JSON file from the output directory, reporting errors."""
+    input_path = os.path.join(output_dir, filename)
+    output_filename = filename.replace('_ocr.json', '_translated.json')
+    output_path = os.path.join(output_dir, output_filename)
+    
+    try:
+        await translate_json_file(input_path, output_path)
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
+
+async def main():
     """Process all OCR JSON files in the output directory."""
     configure_api()
     
     script_dir = os.path.dirname(os.path.abspath(__file__))
     output_dir = os.path.join(script_dir, 'output')
     
-    # Find and process JSON files
-    for filename in os.listdir(output_dir):
-        if not filename.endswith('_ocr.json'):
-            continue
-            
-        input_path = os.path.join(output_dir, filename)
-        output_filename = filename.replace('_ocr.json', '_translated.json')
-        output_path = os.path.join(output_dir, output_filename)
-        
-        try:
-            translate_json_file(input_path, output_path)
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
+    # Find and process JSON files, several at a time
+    with os.scandir(output_dir) as it:
+        files = [e.name for e in it if e.is_file() and e.name.endswith('_ocr.json')]
+    file_sem = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+
+    async def run(filename):
+        async with file_sem:
+            await process_one_file(filename, output_dir)
+
+    await asyncio.gather(*[run(filename) for filename in files])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file